@@ -5,6 +5,24 @@ from collections import OrderedDict
 from argsgenerators.utils import is_source_file
 from argsgenerators.BaseArgsGenerator import BaseArgsGenerator
 
+try:
+    import ijson
+    has_ijson = True
+except ImportError:
+    has_ijson = False
+
+# Only the include directories and definitions are used from the compile commands
+ARGS_PREFIXES = ('-I', '-D')
+
+
+def iter_compile_commands(f):
+    """Yields the entries of an opened compile_commands.json file. When ijson is
+       available the entries are parsed one by one instead of loading the whole file.
+    """
+    if has_ijson:
+        return ijson.items(f, 'item')
+    return iter(json.load(f))
+
 
 class MakefileArgsGenerator(BaseArgsGenerator):
     """Generates a map of file to arguments for project that are build with make build system
@@ -15,20 +33,18 @@ class MakefileArgsGenerator(BaseArgsGenerator):
         self._generate_compile_commands_file()
 
         filepath = os.path.join(self.project_pigaios_dir_path, 'compile_commands.json')
-        with open(filepath) as f:
-            compile_commands = json.load(f)
-      
         file_to_args = {}
-    
+
         print('[+] Generating a map of files to arguments...')
-        for cc in compile_commands:
-            filename = cc['file']
-            if not is_source_file(filename):
-                continue
-        
-            args_filtered = [arg for arg in cc['arguments'] if arg.startswith('-I') or arg.startswith('-D')]
-            file_to_args[filename] = args_filtered
-        
+        with open(filepath, 'rb') as f:
+            for cc in iter_compile_commands(f):
+                filename = cc['file']
+                if not is_source_file(filename):
+                    continue
+
+                args_filtered = [arg for arg in cc['arguments'] if arg.startswith(ARGS_PREFIXES)]
+                file_to_args[filename] = args_filtered
+
         file_to_args = OrderedDict(sorted(file_to_args.items(), key=lambda x: x[0]))
         return file_to_args
 
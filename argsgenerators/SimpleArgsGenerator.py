@@ -2,7 +2,8 @@ import os
 import re
 import networkx as nx
 from collections import OrderedDict
-from argsgenerators.utils import is_source_file, path_endswith
+from multiprocessing import Pool, cpu_count
+from argsgenerators.utils import is_source_file, path_endswith, walk_files
 from argsgenerators.BaseArgsGenerator import BaseArgsGenerator
 
 
@@ -55,6 +56,16 @@ class SimpleArgsGenerator(BaseArgsGenerator):
     return files_without_parent
 
 
+# Below this number of source files reading them in a single process is faster
+# than starting a pool of workers
+MIN_FILES_FOR_POOL = 256
+
+
+def _extract_file_includes(filepath):
+  '''Worker function for the pool used by ProjectIncludesExtractor'''
+  return ProjectIncludesExtractor(None)._extract_includes(filepath)
+
+
 class ProjectIncludesExtractor:
   def __init__(self, project_path):
     self.project_path = project_path
@@ -66,18 +77,31 @@ class ProjectIncludesExtractor:
         files_to_includes (dict of str:list): files with their included files
     '''
 
+    filepaths = []
+    for filepath in walk_files(self.project_path):
+      if is_source_file(filepath):
+        filepaths.append(os.path.abspath(filepath))
+
+    # Reading and matching every line of every file is the expensive part, so
+    # it's split among all the CPUs for big projects
+    total_cpus = cpu_count()
+    if total_cpus > 1 and len(filepaths) >= MIN_FILES_FOR_POOL:
+      pool = Pool(total_cpus)
+      try:
+        results = pool.map(_extract_file_includes, filepaths, chunksize=64)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      results = [self._extract_includes(filepath) for filepath in filepaths]
+
     files_to_includes = {}
-    for root, _, files in os.walk(self.project_path, topdown=False):
-      for name in files:
-        if is_source_file(name):
-          filepath = os.path.abspath(os.path.join(root, name))
-          relpath = os.path.relpath(filepath, self.project_path)
-
-          result = self._extract_includes(filepath)
-          if result:
-            files_to_includes[relpath] = result
-          else:
-            files_to_includes[relpath] = []
+    for filepath, result in zip(filepaths, results):
+      relpath = os.path.relpath(filepath, self.project_path)
+      if result:
+        files_to_includes[relpath] = result
+      else:
+        files_to_includes[relpath] = []
     return files_to_includes
 
   def _extract_includes(self, filepath):
@@ -207,11 +231,9 @@ class ProjectIncludeDirsExtractor:
     '''
 
     project_files = []
-    for root, _, files in os.walk(self.project_path, topdown=False):
-      for name in files:
-        filepath = os.path.abspath(os.path.join(root, name))
-        if filepath.endswith('.h') or filepath.endswith('.hpp'):
-          project_files.append(filepath)
+    for filepath in walk_files(self.project_path):
+      if filepath.endswith(('.h', '.hpp')):
+        project_files.append(os.path.abspath(filepath))
 
     return project_files
 
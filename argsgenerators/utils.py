@@ -1,5 +1,16 @@
 import os
 
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 needs the scandir backport from PyPI
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+SOURCE_EXTENSIONS = ('.h', '.hpp', '.c', '.cpp', '.cc', '.cxx')
+
 def is_source_file(filename):
     '''Checks if the file is source file
     
@@ -10,26 +21,59 @@ def is_source_file(filename):
         (bool): is file source file
     '''
     
-    return filename.endswith('.h') or filename.endswith('.hpp') \
-        or filename.endswith('.c') or filename.endswith('.cpp')
+    return filename.endswith(SOURCE_EXTENSIONS)
 
 def path_endswith(path, trailer):
-    path_parts = splitall(path)
-    trailer_parts = splitall(trailer)
+    '''Checks if the path ends with all the components of the trailer
+
+    Args:
+        path (str): checked path
+        trailer (str): trailing path components, like "sys/types.h"
+
+    Returns:
+        (bool): does the path end with the trailer components
+    '''
+
+    trailer_parts = os.path.normpath(trailer).split(os.sep)
+    path_parts = os.path.normpath(path).split(os.sep)
     return path_parts[-len(trailer_parts):] == trailer_parts
 
-def splitall(path):
-    allparts = []
-    while 1:
-        parts = os.path.split(path)
-        if parts[0] == path:  # sentinel for absolute paths
-            allparts.insert(0, parts[0])
-            break
-        elif parts[1] == path: # sentinel for relative paths
-            allparts.insert(0, parts[1])
-            break
-        else:
-            path = parts[0]
-            allparts.insert(0, parts[1])
-    return allparts
-    
+def walk_files(top):
+    '''Yields the paths of the files below a directory, bottom-up like
+    os.walk(top, topdown=False). scandir is used when available, so
+    the type of each entry comes from the directory listing without
+    calling stat() again
+
+    Args:
+        top (str): directory to walk
+
+    Returns:
+        (generator of str): paths of the files, joined to top
+    '''
+
+    if scandir is None:
+        for root, _, files in os.walk(top, topdown=False):
+            for name in files:
+                yield os.path.join(root, name)
+        return
+
+    try:
+        entries = list(scandir(top))
+    except OSError:
+        return
+
+    files = []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+
+        if not is_dir:
+            files.append(entry.path)
+        elif not entry.is_symlink():
+            for filepath in walk_files(entry.path):
+                yield filepath
+
+    for filepath in files:
+        yield filepath
@@ -32,7 +32,7 @@ from terminalsize import get_terminal_size
 
 from threading import Lock
 from multiprocessing.pool import Pool
-from multiprocessing import cpu_count, Manager
+from multiprocessing import cpu_count
 
 try:
   from colorama import init, Fore, colorama_text
@@ -40,6 +40,12 @@ try:
 except:
   has_colorama = False
 
+try:
+  import msgpack
+  has_msgpack = True
+except ImportError:
+  has_msgpack = False
+
 #-------------------------------------------------------------------------------
 VERSION_VALUE = "Pigaios Source Exporter 1.1"
 
@@ -83,6 +89,40 @@ def is_c_source(arg):
     return True
   return arg.endswith(".c")
 
+#-------------------------------------------------------------------------------
+def is_pch_compatible(args):
+  """
+  Check if the precompiled prelude header, built only with the include paths,
+  can be used with the given arguments. Anything else (the language standard,
+  the target, macros, optimizations...) makes clang either refuse the PCH or
+  see declarations different to the ones the file would see without it.
+  """
+  option = None
+  for arg in args:
+    if option is not None:
+      if option == "-x" and arg != "c":
+        return False
+      option = None
+    elif arg in ("-I", "-x"):
+      option = arg
+    elif not arg.startswith("-I") and arg != "-xc":
+      return False
+  return True
+
+#-------------------------------------------------------------------------------
+def remove_pch_args(args):
+  """ Return a copy of the given arguments without the -include-pch option. """
+  ret = []
+  skip = False
+  for arg in args:
+    if skip:
+      skip = False
+    elif arg == "-include-pch":
+      skip = True
+    else:
+      ret.append(arg)
+  return ret
+
 #-------------------------------------------------------------------------------
 def is_export_header(arg, config):
   export_header = config.get['PROJECT']['export-header']
@@ -223,6 +263,11 @@ class CBaseExporter(object):
     with open(cfg_file) as f:
       self.config = json.load(f)
 
+    # Big projects may keep the list of files in a separate msgpack file
+    files_file = self.config['GENERAL'].get('files-file')
+    if files_file is not None:
+      self.config['FILES'] = self.load_files_file(files_file)
+
     self.db = {}
     self.create_schema(self.config['PROJECT']['export-file'], remove=True)
     self.parallel = False
@@ -231,6 +276,13 @@ class CBaseExporter(object):
     self.errors = 0
     self.fatals = 0
 
+  def load_files_file(self, filename):
+    if not has_msgpack:
+      raise Exception("The project files are in %s but msgpack isn't installed!" % repr(filename))
+
+    with open(filename, "rb") as f:
+      return msgpack.unpack(f, raw=False)
+
   def get_db(self):
     pid = os.getpid()
     tid = current_thread().ident
@@ -318,14 +370,50 @@ class CBaseExporter(object):
     cur.close()
     return self.get_db()
 
-  def insert_row(self, sql, args, cur):
+  def insert_rows(self, sql, rows, cur):
+    if len(rows) == 0:
+      return
+
     if not self.parallel:
-      cur.execute(sql, args)
+      cur.executemany(sql, rows)
     else:
-      self.to_insert_rows.append([sql, args])
+      self.to_insert_rows.extend([[sql, args] for args in rows])
+
+  def __getstate__(self):
+    # The exporter is pickled to run export_one() in the worker processes, but
+    # database connections cannot be shared between processes: each worker
+    # opens its own one when required. The results collected so far by the
+    # main process aren't needed by the workers either, and would be sent
+    # again with every task.
+    state = self.__dict__.copy()
+    state['db'] = {}
+    state['src_definitions'] = []
+    state['to_insert_rows'] = []
+    return state
+
+  def get_pch_args(self):
+    """
+    Return the arguments to use the precompiled C library headers created with
+    the project, if any, when parsing C source files.
+    """
+    pch = self.config['GENERAL'].get('pch')
+    if pch is None or not os.path.exists(pch):
+      return []
+    return ["-include-pch", pch]
 
   def do_export_one(self, args_list):
+    """
+    Export one file in a worker process. The rows to insert, the definitions
+    found and the warning/error counters are returned to the main process that
+    is the only one writing to the database.
+    """
     self.parallel = True
+    self.to_insert_rows = []
+    self.src_definitions = []
+    self.warnings = 0
+    self.errors = 0
+    self.fatals = 0
+
     filename, args, is_c = args_list
     if is_c == 1:
       msg = "[+] CC %s %s" % (filename, " ".join(args))
@@ -344,6 +432,9 @@ class CBaseExporter(object):
       export_log(msg)
       self.fatals += 1
 
+    return (self.to_insert_rows, self.src_definitions, self.warnings,
+            self.errors, self.fatals)
+
   def export_parallel(self):
     c_args = ["-I%s" % ci for ci in self.config['GENERAL']['clang-includes']]
     cpp_args = list(c_args)
@@ -355,6 +446,7 @@ class CBaseExporter(object):
     if tmp != "":
       cpp_args.extend(shlex.split(tmp))
 
+    pch_args = self.get_pch_args()
     pool_args = []
     files_to_args = OrderedDict(sorted(self.config['FILES'].items(), key=lambda x: x[0]))
     files_count = len(files_to_args)
@@ -362,6 +454,8 @@ class CBaseExporter(object):
       filename, file_args = item
       if is_c_source(filename):
         args = file_args + c_args
+        if pch_args and is_pch_compatible(args):
+          args = args + pch_args
         msg = "[{}/{}] CC {} {}".format(idx + 1, files_count, filename, " ".join(args))
         is_c = 1
       elif is_objc_source(filename):
@@ -382,27 +476,32 @@ class CBaseExporter(object):
     cur.execute("PRAGMA journal_mode = MEMORY")
     cur.execute("PRAGMA threads = %d" % total_cpus)
 
-    with Manager() as manager:
-      self.to_insert_rows = manager.list()
-
-      self.header_files = manager.list()
-      self.src_definitions = manager.list()
-
-      pool = Pool(total_cpus)
-      pool.map(self.do_export_one, pool_args, True)
-
-      args = []
-      sql = None
-      while len(self.to_insert_rows) > 0:
-        tmp_sql, arg = self.to_insert_rows.pop()
-        sql = tmp_sql
-        args.append(arg)
+    self.to_insert_rows = []
+    self.src_definitions = []
 
-      if sql is not None:
-        cur.executemany(sql, args)
-
-      self.header_files = list(self.header_files)
-      self.src_definitions = list(self.src_definitions)
+    # Workers only parse the files, the rows they return are written here as
+    # soon as each file is done.
+    pool = Pool(total_cpus)
+    try:
+      cur.execute("BEGIN")
+      results = pool.imap_unordered(self.do_export_one, pool_args)
+      for rows, src_definitions, warnings, errors, fatals in results:
+        for sql, group in itertools.groupby(rows, key=lambda x: x[0]):
+          cur.executemany(sql, [args for _, args in group])
+
+        self.src_definitions.extend(src_definitions)
+        self.warnings += warnings
+        self.errors += errors
+        self.fatals += fatals
+      cur.execute("COMMIT")
+    except:
+      # Don't wait for the files still queued when aborting
+      pool.terminate()
+      raise
+    else:
+      pool.close()
+    finally:
+      pool.join()
 
     cur.close()
 
@@ -623,8 +722,17 @@ class CBaseExporter(object):
       f = None
 
     dones = set()
+    # Every file including a header extracts its definitions again, only the
+    # same exact definition is skipped (the same header may define different
+    # things depending on the macros of the file including it).
+    exported = set()
     sql = "insert into definitions(type, name, source) values (?, ?, ?)"
     for def_type, def_name, def_src in self.src_definitions:
+      key = (def_type, def_name, def_src)
+      if key in exported:
+        continue
+      exported.add(key)
+
       item = str([def_type, def_name])
       cur.execute(sql, (def_type, def_name, def_src))
       if f is not None:
@@ -679,12 +787,15 @@ class CBaseExporter(object):
     if tmp != "":
       cpp_args.extend(shlex.split(tmp))
 
+    pch_args = self.get_pch_args()
     files_to_args = OrderedDict(sorted(self.config['FILES'].items(), key=lambda x: x[0]))
     files_count = len(files_to_args)
     for idx, item in enumerate(files_to_args.items()):
       filename, file_args = item
       if is_c_source(filename):
         args = file_args + c_args
+        if pch_args and is_pch_compatible(args):
+          args = args + pch_args
         msg = "[{}/{}] CC {} {}".format(idx + 1, files_count, filename, " ".join(args))
         is_c = True
       else:
@@ -19,11 +19,15 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import os
+import sys
 import json
+from array import array
 from threading import current_thread
 
 import clang.cindex
-from clang.cindex import Diagnostic, CursorKind, TokenKind
+from clang.cindex import Diagnostic, CursorKind, TokenKind, SourceRange
+from clang.cindex import conf, callbacks
 import re
 
 from base_support import *
@@ -31,23 +35,71 @@ from SimpleEval import simple_eval
 from simple_macro_parser import CMacroExtractor
 
 #-------------------------------------------------------------------------------
-CONDITIONAL_OPERATORS = ["==", "!=", "<", ">", ">=", "<=", "?"]
-INLINE_NAMES = ["inline", "__inline", "__inline__", "__forceinline", "always_inline"]
+CONDITIONAL_OPERATORS = frozenset(["==", "!=", "<", ">", ">=", "<=", "?"])
+LOGICAL_OPERATORS = frozenset(["||", "&&"])
+SWITCH_TOKEN_KINDS = frozenset([TokenKind.KEYWORD, TokenKind.LITERAL])
 
 SCAN_ELEMENTS = [CursorKind.FUNCTION_DECL, CursorKind.FUNCTION_TEMPLATE,
                  CursorKind.CXX_METHOD, CursorKind.CONSTRUCTOR,
                  CursorKind.DESTRUCTOR, CursorKind.OBJC_INSTANCE_METHOD_DECL]
 
+# Range of literal kinds passed to the visit_LITERAL member of the visitor, as
+# integer values so checking them doesn't need to compare CursorKind objects.
+FIRST_LITERAL_KIND = CursorKind.INTEGER_LITERAL.value
+LAST_LITERAL_KIND = CursorKind.STRING_LITERAL.value
+
+# Array and function pointer type names, as in 'int [16]' or 'int (*)(void *)'
+RE_ARRAY_TYPE = re.compile(r'\[[A-Za-z0-9]*\]')
+RE_FUNCTION_POINTER_TYPE = re.compile(r'\(\*+\)')
+
+# Preprocessor directives commented out by CClangExporter.strip_macros()
+RE_PREPROCESSOR_LINE = re.compile(br'^[ \t]*#')
+
+# CLang indexes created by each process, keyed by process id. Exporters are
+# unpickled again in the workers for every file, so the index is kept here to
+# reuse it for all the files a worker parses.
+CLANG_INDEXES = {}
+
+# Values returned to clang_visitChildren() from the visitor callback
+CXChildVisit_Break = 0
+CXChildVisit_Continue = 1
+CXChildVisit_Recurse = 2
+
 #-----------------------------------------------------------------------------
 def basename(path):
-  pos1 = path[::-1].find("\\")
-  pos2 = path[::-1].find("/")
+  # Either separator is accepted as paths may come from Unix or Windows
+  pos = max(path.rfind("/"), path.rfind("\\"))
+  return path[pos+1:]
 
-  if pos1 == -1: pos1 = len(path)
-  if pos2 == -1: pos2 = len(path)
-  pos = min(pos1, pos2)
+#-------------------------------------------------------------------------------
+def first(iterable):
+  """ Return the first element of the given iterable or None if it's empty. """
+  return next(iter(iterable), None)
 
-  return path[len(path)-pos:]
+#-------------------------------------------------------------------------------
+def get_libclang_version():
+  """ Return the version string of the libclang library used by the bindings. """
+  # Not every version of the bindings declares the return type of this one
+  func = conf.lib.clang_getClangVersion
+  func.restype = clang.cindex._CXString
+  func.errcheck = clang.cindex._CXString.from_result
+  return func()
+
+#-------------------------------------------------------------------------------
+def create_pch(filename, source, args, pch):
+  """
+  Precompile the header with the given source code and save it to the file
+  @pch, with the same libclang library later used to parse the files using it.
+  The header is only parsed from memory, @filename is never written.
+  """
+  index = clang.cindex.Index.create()
+  tu = index.parse(filename, args=["-x", "c-header"] + args,
+                   unsaved_files=[(filename, source)],
+                   options=clang.cindex.TranslationUnit.PARSE_INCOMPLETE)
+  for diag in tu.diagnostics:
+    if diag.severity >= Diagnostic.Error:
+      raise Exception("%s: %s" % (severity2text(diag.severity), diag.spelling))
+  tu.save(pch)
 
 #-------------------------------------------------------------------------------
 def severity2text(severity):
@@ -65,28 +117,38 @@ def severity2text(severity):
     return "unknown"
 
 #-------------------------------------------------------------------------------
-def is_inline(cursor):
-  if cursor.kind != CursorKind.FUNCTION_DECL:
-    return False
-
-  for token in cursor.get_tokens():
-    tkn = token.spelling
-    for name in INLINE_NAMES:
-      if tkn.find(name) > -1:
-        return True
-    if tkn == "{":
-      break
-
-  return False
+def is_inline_token(tkn):
+  # Matches inline, __inline, __inline__, __forceinline, always_inline and any
+  # other spelling containing them, like __always_inline.
+  return "inline" in tkn
 
 #-------------------------------------------------------------------------------
-def is_static(cursor):
+def scan_prefix_tokens(cursor):
+  """
+  Return a tuple with the spelling of the first token of the given cursor and
+  whether it is an inline and/or static function, tokenizing the cursor just
+  once.
+  """
+  tokens = cursor.get_tokens()
+  first_token = next(tokens, None)
+  if first_token is None:
+    return None, False, False
+
+  first_token = first_token.spelling
   if cursor.kind != CursorKind.FUNCTION_DECL:
-    return False
-  token = next(cursor.get_tokens(), None)
-  if token is None:
-    return False
-  return token.spelling == "static"
+    return first_token, False, False
+
+  inline = is_inline_token(first_token)
+  if not inline and first_token != "{":
+    for token in tokens:
+      tkn = token.spelling
+      if is_inline_token(tkn):
+        inline = True
+        break
+      if tkn == "{":
+        break
+
+  return first_token, inline, first_token == "static"
 
 #-------------------------------------------------------------------------------
 def dump_ast(cursor, level = 0):
@@ -94,13 +156,14 @@ def dump_ast(cursor, level = 0):
   if token is not None:
     token = token.spelling
 
-  print("  "*level, cursor.kind, repr(cursor.spelling), repr(token), cursor.type.spelling, cursor.location)
+  print("  "*level, cursor.kind.name, repr(cursor.spelling), repr(token), cursor.type.spelling, cursor.location)
   for children in cursor.get_children():
     dump_ast(children, level+1)
 
 #-------------------------------------------------------------------------------
-def json_dump(x):
-  return json.dumps(x, ensure_ascii=False)
+# json.dumps() creates a new JSONEncoder on each call when it is given any non
+# default option, so create the one used for the per-function fields just once.
+json_dump = json.JSONEncoder(ensure_ascii=False).encode
 
 #-------------------------------------------------------------------------------
 class CCLangVisitor:
@@ -138,15 +201,18 @@ class CCLangVisitor:
     # preprocessor is run. Well, CLang...
 
     #print("Visiting LITERAL", cursor.spelling)
+    # Every property access of a cursor or token is a call into libclang, so
+    # read each one just once.
+    kind = cursor.kind
     for token in cursor.get_tokens():
       if token.kind != TokenKind.LITERAL:
         continue
 
       tmp = token.spelling
-      if cursor.kind == CursorKind.FLOATING_LITERAL:
+      if kind == CursorKind.FLOATING_LITERAL:
         if tmp.endswith("f"):
           tmp = tmp.strip("f")
-      elif cursor.kind == CursorKind.STRING_LITERAL or tmp.find('"') > -1 or tmp.find("'") > -1:
+      elif kind == CursorKind.STRING_LITERAL or tmp.find('"') > -1 or tmp.find("'") > -1:
         if tmp.startswith('"') and tmp.endswith('"'):
           tmp = get_printable_value(tmp.strip('"'))
           self.externals.add(tmp)
@@ -186,6 +252,32 @@ class CCLangVisitor:
 
     return True
 
+  def get_condition_tokens(self, cursor):
+    # Tokenize only from the 'if' keyword up to the end of the condition, the
+    # first children, instead of the whole statement including its body. It's
+    # only done when the first children is followed by the closing parenthesis,
+    # otherwise it isn't the whole condition (i.e., C++ if statements with an
+    # initializer or a declaration) and the whole statement is tokenized.
+    children = iter(cursor.get_children())
+    cond = next(children, None)
+    body = next(children, None)
+    if cond is not None and body is not None and \
+       not cond.kind.is_declaration() and cond.kind != CursorKind.DECL_STMT:
+      start = cursor.extent.start
+      end = cond.extent.end
+      body_start = body.extent.start
+      if start.file is not None and end.file is not None and \
+         body_start.file is not None and \
+         start.file.name == end.file.name == body_start.file.name and \
+         start.offset < end.offset <= body_start.offset:
+        tu = cursor.translation_unit
+        after = first(tu.get_tokens(extent=SourceRange.from_locations(end, body_start)))
+        if after is not None and after.spelling == ")":
+          extent = SourceRange.from_locations(start, end)
+          return tu.get_tokens(extent=extent)
+
+    return cursor.get_tokens()
+
   def visit_IF_STMT(self, cursor):
     #print("Visiting IF_STMT")
     # Perform some (fortunately) not too complex parsing of the IF_STMT as the
@@ -194,8 +286,8 @@ class CCLangVisitor:
     par_level = 0
     tmp_conds = 0
     at_least_one_parenthesis = False
-    for token in cursor.get_tokens():
-      clean_token = str(token.spelling)
+    for token in self.get_condition_tokens(cursor):
+      clean_token = token.spelling
       if clean_token == "(":
         # The first time we find a parenthesis we can consider there is at least
         # one condition.
@@ -211,42 +303,30 @@ class CCLangVisitor:
         if par_level == 0 and at_least_one_parenthesis:
           break
       # If there are 2 or more conditions, these operators will be required
-      elif clean_token in ["||", "&&"]:
+      elif clean_token in LOGICAL_OPERATORS:
         tmp_conds += 1
 
     self.conditions += tmp_conds
 
   def visit_CALL_EXPR(self, cursor):
     #print("Visiting CALL_EXPR")
-    if cursor.spelling == self.name:
+    spelling = cursor.spelling
+    if spelling == self.name:
       self.recursive = True
 
     token = next(cursor.get_tokens(), None)
     if token is not None:
       token = token.spelling
       if token != "" and token is not None:
-        if token != cursor.spelling:
-          self.indirects.append(cursor.spelling)
+        if token != spelling:
+          self.indirects.append(spelling)
 
-    spelling = cursor.spelling
-    try:
-      self.calls[cursor.spelling] += 1
-    except:
-      self.calls[cursor.spelling] = 1
+    self.calls[spelling] = self.calls.get(spelling, 0) + 1
 
   def visit_loop(self, cursor):
     #print("Visiting LOOP")
     self.loops += 1
 
-  def visit_WHILE_STMT(self, cursor):
-    self.visit_loop(cursor)
-
-  def visit_FOR_STMT(self, cursor):
-    self.visit_loop(cursor)
-
-  def visit_DO_STMT(self, cursor):
-    self.visit_loop(cursor)
-
   def visit_SWITCH_STMT(self, cursor):
     #print("Visiting SWITCH_STMT")
     # As always, the easiest way to get the cases and values from a SWITCH_STMT
@@ -255,11 +335,12 @@ class CCLangVisitor:
     next_case = False
     default = 0
     for token in cursor.get_tokens():
-      if token.kind not in [TokenKind.KEYWORD, TokenKind.LITERAL]:
+      kind = token.kind
+      if kind not in SWITCH_TOKEN_KINDS:
         continue
 
-      if token.kind == TokenKind.KEYWORD:
-        clean_token = str(token.spelling)
+      if kind == TokenKind.KEYWORD:
+        clean_token = token.spelling
         # The next token will be the case value
         if clean_token == "case":
           next_case = True
@@ -279,11 +360,12 @@ class CCLangVisitor:
   def visit_BINARY_OPERATOR(self, cursor):
     for token in cursor.get_tokens():
       if token.kind == TokenKind.PUNCTUATION:
-        if token.spelling == "*":
+        spelling = token.spelling
+        if spelling == "*":
           self.mul = True
-        elif token.spelling == "/":
+        elif spelling == "/":
           self.div = True
-        elif token.spelling in CONDITIONAL_OPERATORS:
+        elif spelling in CONDITIONAL_OPERATORS:
           self.conditions += 1
 
   def visit_PARM_DECL(self, cursor):
@@ -298,10 +380,26 @@ class CCLangVisitor:
       if name in self.global_variables:
         self.globals_uses.add(name)
 
+# Map of cursor kind values to the CCLangVisitor member handling them, built once
+# instead of looking up 'visit_<KIND>' with dir() and getattr() for every node.
+CCLangVisitor.DISPATCH = {
+  CursorKind.IF_STMT.value: CCLangVisitor.visit_IF_STMT,
+  CursorKind.CALL_EXPR.value: CCLangVisitor.visit_CALL_EXPR,
+  CursorKind.WHILE_STMT.value: CCLangVisitor.visit_loop,
+  CursorKind.FOR_STMT.value: CCLangVisitor.visit_loop,
+  CursorKind.DO_STMT.value: CCLangVisitor.visit_loop,
+  CursorKind.SWITCH_STMT.value: CCLangVisitor.visit_SWITCH_STMT,
+  CursorKind.BINARY_OPERATOR.value: CCLangVisitor.visit_BINARY_OPERATOR,
+  CursorKind.PARM_DECL.value: CCLangVisitor.visit_PARM_DECL,
+  CursorKind.VAR_DECL.value: CCLangVisitor.visit_VAR_DECL,
+  CursorKind.DECL_REF_EXPR.value: CCLangVisitor.visit_DECL_REF_EXPR,
+  CursorKind.ENUM_DECL.value: CCLangVisitor.visit_ENUM_DECL,
+}
+
 #-------------------------------------------------------------------------------
 class CLangParser:
-  def __init__(self):
-    self.index = None
+  def __init__(self, index=None):
+    self.index = index
     self.tu = None
     self.diags = None
     self.source_path = None
@@ -312,7 +410,8 @@ class CLangParser:
 
   def parse(self, src, args):
     self.source_path = src
-    self.index = clang.cindex.Index.create()
+    if self.index is None:
+      self.index = clang.cindex.Index.create()
     self.tu = self.index.parse(path=src, args=args)
     self.diags = self.tu.diagnostics
     for diag in self.diags:
@@ -328,7 +427,8 @@ class CLangParser:
 
   def parse_buffer(self, src, buf, args):
     self.source_path = src
-    self.index = clang.cindex.Index.create()
+    if self.index is None:
+      self.index = clang.cindex.Index.create()
     self.tu = self.index.parse(path=src, args=args, unsaved_files=[(src, buf)])
     self.diags = self.tu.diagnostics
     for diag in self.diags:
@@ -346,52 +446,103 @@ class CLangParser:
     if cursor is None:
       cursor = self.tu.cursor
 
-    for children in cursor.get_children():
-      self.total_elements += 1
-
-      # Check if a visit_EXPR_TYPE member exists in the given object and call it
-      # passing the current children element.
-      kind_name = str(children.kind)
-      element = kind_name[kind_name.find(".")+1:]
-      method_name = 'visit_%s' % element
-      if method_name in dir(obj):
-        func = getattr(obj, method_name)
-        if func(children):
-          continue
-
-      # Same as before but we pass to the member any literal expression.
-      method_name = 'visit_LITERAL'
-      if children.kind >= CursorKind.INTEGER_LITERAL and \
-           children.kind <= CursorKind.STRING_LITERAL:
-        if method_name in dir(obj):
-          func = getattr(obj, method_name)
-          if func(children):
-            continue
+    # Walk the whole sub-tree with a single clang_visitChildren() call, letting
+    # libclang do the recursion, instead of calling get_children() (and, so,
+    # clang_visitChildren()) again for every single node of the AST.
+    tu = cursor._tu
+    dispatch = obj.DISPATCH
+    error = []
+    def visit(children, parent, data):
+      try:
+        # Create reference to TU so it isn't GC'd before the Cursor.
+        children._tu = tu
+        self.total_elements += 1
+
+        # Call the visit_EXPR_TYPE member registered for this kind of element, if
+        # any, passing the current children element.
+        kind = children.kind.value
+        func = dispatch.get(kind)
+        if func is not None and func(obj, children):
+          return CXChildVisit_Continue
+
+        # Same as before but we pass to the member any literal expression.
+        if FIRST_LITERAL_KIND <= kind <= LAST_LITERAL_KIND and \
+             obj.visit_LITERAL(children):
+          return CXChildVisit_Continue
+
+        return CXChildVisit_Recurse
+      except:
+        # Exceptions cannot cross the C callback, so stop the traversal and
+        # re-raise it once clang_visitChildren() returns.
+        error.append(sys.exc_info()[1])
+        return CXChildVisit_Break
 
-      self.visitor(obj, cursor=children)
+    conf.lib.clang_visitChildren(cursor, callbacks['cursor_visit'](visit), None)
+    if error:
+      raise error[0]
 
 #-------------------------------------------------------------------------------
 class CClangExporter(CBaseExporter):
   def __init__(self, cfg_file, only_header_els):
     CBaseExporter.__init__(self, cfg_file)
+    # A single index is used to parse all the translation units
+    self.index = None
     self.source_cache = {}
     self.global_variables = set()
 
-    self.header_files = []
     self.src_definitions = []
     self.only_header_els = only_header_els
 
+  def __getstate__(self):
+    # The CLang index cannot be pickled, workers create their own one.
+    state = CBaseExporter.__getstate__(self)
+    state['index'] = None
+    return state
+
+  def get_index(self):
+    if self.index is None:
+      # Never reuse an index inherited from the parent process after forking
+      pid = os.getpid()
+      index = CLANG_INDEXES.get(pid)
+      if index is None:
+        index = clang.cindex.Index.create()
+        CLANG_INDEXES[pid] = index
+      self.index = index
+    return self.index
+
+  def get_source(self, filename):
+    """
+    Return a tuple with the raw contents of the given file and an array with the
+    offsets where each line starts (plus the total size), reading the file only
+    the first time it's requested.
+    """
+    if filename not in self.source_cache:
+      with open(filename, "rb") as f:
+        raw = f.read()
+
+      offsets = array("l", [0])
+      pos = raw.find(b"\n")
+      while pos > -1:
+        offsets.append(pos + 1)
+        pos = raw.find(b"\n", pos + 1)
+      if offsets[-1] != len(raw):
+        offsets.append(len(raw))
+      self.source_cache[filename] = raw, offsets
+
+    return self.source_cache[filename]
+
   def get_function_source(self, cursor):
     start_line = cursor.extent.start.line
     end_line   = cursor.extent.end.line
 
     start_loc = cursor.location
     filename = start_loc.file.name
-    if filename not in self.source_cache:
-      self.source_cache[filename] = open(filename, "rb").readlines()
+    raw, offsets = self.get_source(filename)
 
-    source = "".join(self.source_cache[filename][start_line-1:end_line])
-    return source
+    total_lines = len(offsets) - 1
+    start = offsets[min(start_line - 1, total_lines)]
+    end = offsets[min(end_line, total_lines)]
+    return raw[start:end]
 
   def get_prototype(self, cursor):
     args = []
@@ -406,14 +557,19 @@ class CClangExporter(CBaseExporter):
     return prototype
 
   def strip_macros(self, filename):
+    raw, offsets = self.get_source(filename)
+    lines = raw.split(b"\n")
+    if raw.endswith(b"\n"):
+      lines.pop()
+
     ret = []
-    for line in open(filename, "rb").readlines():
-      line = line.strip("\r").strip("\n")
-      if line.find("#include") == -1 and line.strip(" ").strip("\t").strip(" ").startswith("#"):
-        ret.append("// stripped: %s" % line)
+    for line in lines:
+      line = line.lstrip(b"\r")
+      if line.find(b"#include") == -1 and RE_PREPROCESSOR_LINE.match(line):
+        ret.append(b"// stripped: " + line)
         continue
       ret.append(line)
-    return "\n".join(ret)
+    return b"\n".join(ret)
 
   def element2kind(self, element):
     if element.kind == CursorKind.STRUCT_DECL:
@@ -429,21 +585,14 @@ class CClangExporter(CBaseExporter):
     else:
       return "" # Unknown thing
 
-  def clean_name(self, name):
-    return "".join([c for c in name if c.isalpha() or c.isdigit() or c == "_"]).rstrip()
-
   def parse_bitfield(self, field):
     elem_name = field.spelling
     type_name = field.type.spelling
-    bit_size = list(list(field.get_children())[0].get_tokens())[0].spelling
+    bit_size = first(first(field.get_children()).get_tokens()).spelling
     return type_name, elem_name, bit_size
 
   def is_array(self, field):
-    type_name = field.type.spelling
-    if re.findall(r'\[[A-Za-z0-9]*\]', type_name):
-      return True
-    else:
-      return False
+    return RE_ARRAY_TYPE.search(field.type.spelling) is not None
 
   def is_primitive_field(self, field):
     # For such cases as PACKED_ATTR, UNEXPOSED_ATTR and etc
@@ -462,9 +611,9 @@ class CClangExporter(CBaseExporter):
     if field.kind == CursorKind.STRUCT_DECL:
       return True
 
-    children = list(field.get_children())
-    if children:
-      if children[0].kind == CursorKind.STRUCT_DECL:
+    child = first(field.get_children())
+    if child is not None:
+      if child.kind == CursorKind.STRUCT_DECL:
         return True
 
     return False
@@ -473,9 +622,9 @@ class CClangExporter(CBaseExporter):
     if field.kind == CursorKind.UNION_DECL:
       return True
 
-    children = list(field.get_children())
-    if children:
-      if children[0].kind == CursorKind.UNION_DECL:
+    child = first(field.get_children())
+    if child is not None:
+      if child.kind == CursorKind.UNION_DECL:
         return True
 
     return False
@@ -490,7 +639,7 @@ class CClangExporter(CBaseExporter):
         return None
 
       if field.is_bitfield():
-        bit_length = list(list(field.get_children())[0].get_tokens())[0].spelling
+        bit_length = first(first(field.get_children()).get_tokens()).spelling
         field_src = "%s %s: %s;" % (type_name, field_name, bit_length)
         return field_name, field_src
 
@@ -499,7 +648,7 @@ class CClangExporter(CBaseExporter):
         field_src = type_name[:pos] + field_name + type_name[pos:] + ";"
         return field_name, field_src
 
-      elif re.findall(r'\(\*+\)', type_name):
+      elif RE_FUNCTION_POINTER_TYPE.search(type_name):
         pos = type_name.find(')(')
         field_src = (type_name[:pos] + " %s " + type_name[pos:] + ";") % field_name
         return field_name, field_src
@@ -511,7 +660,7 @@ class CClangExporter(CBaseExporter):
 
     elif self.is_struct(field):
         if field.kind == CursorKind.FIELD_DECL:
-          struct = list(field.get_children())[0]
+          struct = first(field.get_children())
           struct_name, struct_src = self.parse_struct(struct, is_nested=True)
         else:
           struct = self.parse_struct(field, is_nested=False)
@@ -527,7 +676,7 @@ class CClangExporter(CBaseExporter):
         return field.spelling, struct_src
     elif self.is_union(field):
         if field.kind == CursorKind.FIELD_DECL:
-          union = list(field.get_children())[0]
+          union = first(field.get_children())
           union_name, union_src = self.parse_union(union, is_nested=True)
         else:
           union = self.parse_union(field, is_nested=True)
@@ -597,7 +746,7 @@ class CClangExporter(CBaseExporter):
     underlying_typename = typedef.underlying_typedef_type.spelling
 
     if '(anonymous struct' in underlying_typename or underlying_typename.startswith('struct'):
-      child = list(typedef.get_children())[0]
+      child = first(typedef.get_children())
       if child.kind == CursorKind.STRUCT_DECL and child.spelling == '':
         struct = child
         struct_name, struct_src = self.parse_struct(struct, is_nested=True)
@@ -607,7 +756,7 @@ class CClangExporter(CBaseExporter):
       else:
         return None
     elif '(anonymous union' in underlying_typename or underlying_typename.startswith('union'):
-      child = list(typedef.get_children())[0]
+      child = first(typedef.get_children())
       if child.kind == CursorKind.UNION_DECL and child.spelling == '':
         union = child
         union_name, union_src = self.parse_union(union, is_nested=True)
@@ -618,7 +767,7 @@ class CClangExporter(CBaseExporter):
         return None
     else:
       # For case "typedef int (*bar)(int *, void*);"
-      if re.findall(r'\(\*+\)', underlying_typename):
+      if RE_FUNCTION_POINTER_TYPE.search(underlying_typename):
         pos = underlying_typename.find(')(')
         src = ("typedef " + underlying_typename[:pos] + " %s " + underlying_typename[pos:] + ";") % typedef_name
         return typedef_name, src
@@ -645,12 +794,11 @@ class CClangExporter(CBaseExporter):
 
     for enum_constant in enum.get_children():
       label = enum_constant.spelling
-      children = list(enum_constant.get_children())
-      if not children:
+      value_cursor = first(enum_constant.get_children())
+      if value_cursor is None:
         ret.append("%s," % label)
         continue
 
-      value_cursor = children[0]
       value = self.get_enum_constant_value(value_cursor)
       ret.append("%s = %s," % (label, value))
 
@@ -658,9 +806,33 @@ class CClangExporter(CBaseExporter):
     enum_src = '\n'.join(ret)
     return enum_name, enum_src
 
+  def parse_file(self, filename, args):
+    """
+    Parse the given file, again without the precompiled header if clang cannot
+    use it or there are errors using it (i.e., the file defines feature test
+    macros like _GNU_SOURCE before including the C library headers). Returns
+    the parser and the arguments that were finally used.
+    """
+    parser = CLangParser(self.get_index())
+    if "-include-pch" not in args:
+      parser.parse(filename, args)
+      return parser, args
+
+    try:
+      parser.parse(filename, args)
+      pch_failed = parser.errors + parser.fatals > 0
+    except clang.cindex.TranslationUnitLoadError:
+      pch_failed = True
+
+    if pch_failed:
+      export_log("%s: warning: errors using the precompiled header, parsing it again without it" % filename)
+      args = remove_pch_args(args)
+      parser = CLangParser(self.get_index())
+      parser.parse(filename, args)
+    return parser, args
+
   def export_one(self, filename, args, is_c):
-    parser = CLangParser()
-    parser.parse(filename, args)
+    parser, args = self.parse_file(filename, args)
     self.warnings += parser.warnings
     self.errors += parser.errors
     self.fatals += parser.fatals
@@ -677,7 +849,7 @@ class CClangExporter(CBaseExporter):
         # We haven't discovered a single thing and errors happened parsing the
         # file, let's try again but stripping macros this time...
         new_src = self.strip_macros(filename)
-        parser = CLangParser()
+        parser = CLangParser(self.get_index())
         parser.parse_buffer(filename, new_src, args)
         self.warnings += parser.warnings
         self.errors += parser.errors
@@ -697,6 +869,20 @@ class CClangExporter(CBaseExporter):
         if name != "" and len(enums[name]) > 0:
           self.src_definitions.append(["enum", name, enums[name]])
 
+      # The functions found are inserted all at once, after the whole file is
+      # processed, with a single executemany() call.
+      sql = """insert into functions(
+                             ea, name, prototype, prototype2, conditions,
+                             constants, constants_json, loops, switchs,
+                             switchs_json, calls, externals, filename,
+                             callees_json, source, recursive, indirect, globals,
+                             inlined, static, basename)
+                           values
+                             ((select count(ea)+1 from functions),
+                              ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                              ?, ?, ?, ?, ?, ?)"""
+      rows = []
+
       dones = set()
       for element in parser.tu.cursor.get_children():
         if element.kind == CursorKind.STRUCT_DECL:
@@ -735,17 +921,14 @@ class CClangExporter(CBaseExporter):
           self.global_variables = name
 
         if element.kind in SCAN_ELEMENTS:
-          static = element.is_static_method()
-          tokens = element.get_tokens()
-          token = next(tokens, None)
-          if token is not None:
-            if token.spelling == "extern":
-              continue
+          first_token, inlined, static = scan_prefix_tokens(element)
+          if first_token == "extern":
+            continue
 
           obj = CCLangVisitor(element.spelling)
           obj.global_variables = self.global_variables
-          obj.is_inlined = is_inline(element)
-          obj.is_static = is_static(element)
+          obj.is_inlined = inlined
+          obj.is_static = static
           parser.visitor(obj, cursor=element)
 
           prototype = self.get_prototype(element)
@@ -754,24 +937,16 @@ class CClangExporter(CBaseExporter):
           if source is None or source == "":
             continue
 
-          sql = """insert into functions(
-                                 ea, name, prototype, prototype2, conditions,
-                                 constants, constants_json, loops, switchs,
-                                 switchs_json, calls, externals, filename,
-                                 callees_json, source, recursive, indirect, globals,
-                                 inlined, static, basename)
-                               values
-                                 ((select count(ea)+1 from functions),
-                                  ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
-                                  ?, ?, ?, ?, ?, ?)"""
           args = (obj.name, prototype, prototype2, obj.conditions,
                   len(obj.constants), json_dump(list(obj.constants)),
                   obj.loops, len(obj.switches), json_dump(list(obj.switches)),
-                  len(obj.calls.keys()), len(obj.externals),
+                  len(obj.calls), len(obj.externals),
                   filename, json_dump(obj.calls), source, obj.recursive,
                   len(obj.indirects), len(obj.globals_uses), obj.is_inlined,
                   obj.is_static, basename(filename).lower(), )
-          self.insert_row(sql, args, cur)
+          rows.append(args)
+
+      self.insert_rows(sql, rows, cur)
 
       if not self.parallel:
         cur.execute("COMMIT")
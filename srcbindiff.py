@@ -23,8 +23,9 @@ from __future__ import print_function
 import os
 import sys
 import json
+import errno
+import hashlib
 import subprocess
-from collections import OrderedDict
 import argparse
 from argsgenerators import MakefileArgsGenerator
 from argsgenerators import SimpleArgsGenerator
@@ -33,11 +34,20 @@ from argsgenerators import SimpleArgsGenerator
 from exporters.base_support import is_source_file, is_header_file, is_export_header
 
 try:
-  from colorama import colorama_text, Style, init
-  init()
-  has_colorama = True
-except:
-  has_colorama = False
+  input = raw_input  # Python 2
+except NameError:
+  pass               # Python 3
+
+try:
+  import msgpack
+  has_msgpack = True
+except ImportError:
+  has_msgpack = False
+
+try:
+  from shutil import which
+except ImportError:
+  from distutils.spawn import find_executable as which
 
 try:
   from exporters import clang_exporter
@@ -51,24 +61,89 @@ Copyright (c) 2018, Joxean Koret"""
 SBD_PROJECT_COMMENT = "# Default Source-Binary-Differ project configuration"
 PROJECT_PIGAIOS_DIR = '__pigaios__'
 DEFAULT_PROJECT_FILE = os.path.join(PROJECT_PIGAIOS_DIR, 'sbd-project.json')
+MSGPACK_FILES_FILE = os.path.join(PROJECT_PIGAIOS_DIR, 'files.msgpack')
+
+# C library headers precompiled when a project is created with --pch
+PRELUDE_HEADERS = ['assert.h', 'ctype.h', 'errno.h', 'limits.h', 'stdarg.h',
+                   'stddef.h', 'stdint.h', 'stdio.h', 'stdlib.h', 'string.h',
+                   'time.h']
+
+# Valid answers to the question of overwriting an existing project file
+YES_NO_ANSWERS = frozenset(['', 'y', 'n', 'yes', 'no'])
+
+# Where the include paths of each clang binary found are remembered
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pigaios')
+
+# Environment variables changing the include paths clang reports
+CLANG_INCLUDE_ENV_VARS = ['CPATH', 'C_INCLUDE_PATH', 'CPLUS_INCLUDE_PATH']
+
+#-------------------------------------------------------------------------------
+def dump_project_config(config):
+  """ Serialize the project configuration to JSON bytes, with the keys sorted. """
+  return json.dumps(config, indent=4, sort_keys=True).encode("utf-8")
 
 #-------------------------------------------------------------------------------
 class CSBDProject:
-  def __init__(self, build_system=None):
+  def __init__(self, build_system=None, use_pch=False, use_msgpack=False):
     self.build_system = build_system
+    self.use_pch = use_pch
+    self.use_msgpack = use_msgpack
+
+  def get_clang_cache_file(self):
+    """
+    Return the file where the include paths of the clang binary in the PATH
+    are cached, or None if there is no clang binary. The name depends on the
+    binary's path, size and modification time, so upgrading clang changes it,
+    and on the environment variables adding directories to the search list.
+    """
+    clang = which('clang')
+    if clang is None:
+      return None
+
+    clang = os.path.realpath(clang)
+    st = os.stat(clang)
+    data = "%s\n%d\n%d" % (clang, st.st_size, int(st.st_mtime))
+    for name in CLANG_INCLUDE_ENV_VARS:
+      data += "\n%s=%s" % (name, os.environ.get(name, ""))
+    key = hashlib.sha1(data.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, 'clang_includes_%s.json' % key)
 
   def resolve_clang_includes(self):
-    cmd = 'echo | clang -E -Wp,-v -'
-    proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    stdout = proc.stdout.read()
+    cache_file = self.get_clang_cache_file()
+    if cache_file is not None and os.path.exists(cache_file):
+      try:
+        with open(cache_file, 'r') as f:
+          return json.load(f)
+      except (IOError, ValueError):
+        pass
+
+    includes = self.run_clang_includes()
+    if cache_file is not None and len(includes) > 0:
+      try:
+        if not os.path.exists(CACHE_DIR):
+          os.makedirs(CACHE_DIR)
+        with open(cache_file, 'w') as f:
+          json.dump(includes, f)
+      except (IOError, OSError):
+        pass
 
-    stdout = stdout.decode()
+    return includes
+
+  def run_clang_includes(self):
+    cmd = ['clang', '-E', '-Wp,-v', '-']
+    try:
+      proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError:
+      print("[!] Cannot run clang to find its include paths.")
+      return []
 
-    lines = stdout.split('\n')
+    # Preprocess an empty input, only the include paths are wanted
+    proc.stdin.close()
     begin = False
     includes = []
 
-    for l in lines:
+    for raw in iter(proc.stdout.readline, b''):
+      l = raw.decode().rstrip('\r\n')
       if l == '#include <...> search starts here:':
         begin = True
         continue
@@ -79,24 +154,119 @@ class CSBDProject:
       if begin:
         includes.append(l.strip())
 
+    # Nothing else after the search list is needed
+    if proc.poll() is None:
+      proc.terminate()
+    proc.stdout.close()
+    proc.wait()
+
     return includes
 
+  def create_prelude_pch(self, includes):
+    """
+    Precompile a header including the most common C library headers, so they
+    aren't parsed again for every C source file exported. It's done with the
+    libclang library used by the exporter, as a PCH can only be loaded by the
+    same clang version that created it. The name of the PCH depends on that
+    version and the include paths, so an existing one is reused as long as
+    they don't change.
+
+    Returns the path of the PCH or None if it cannot be created.
+    """
+    if not has_clang:
+      print("[!] Python CLang bindings aren't installed, not creating a precompiled header.")
+      return None
+
+    version = clang_exporter.get_libclang_version()
+    data = "\n".join([version] + includes + PRELUDE_HEADERS)
+    key = hashlib.sha1(data.encode("utf-8")).hexdigest()[:16]
+    pch = os.path.join(PROJECT_PIGAIOS_DIR, 'prelude-%s.pch' % key)
+    if os.path.exists(pch):
+      return pch
+
+    if not os.path.exists(PROJECT_PIGAIOS_DIR):
+      os.makedirs(PROJECT_PIGAIOS_DIR)
+
+    # The prelude only exists in memory, so source discovery never finds it
+    source = "".join(["#include <%s>\n" % header for header in PRELUDE_HEADERS])
+    args = ["-I%s" % include for include in includes]
+    try:
+      clang_exporter.create_pch('pigaios-prelude.h', source, args, pch)
+    except Exception as e:
+      print("[!] Cannot create the precompiled header %s, not using it: %s" % (repr(pch), str(e)))
+      if os.path.exists(pch):
+        os.remove(pch)
+      return None
+    return pch
+
   def create_project(self, path, project_file):
-    if os.path.exists(project_file):
+    dirname = os.path.dirname(project_file)
+    if dirname != "" and not os.path.exists(dirname):
+      os.makedirs(dirname)
+
+    # Create the file only if it doesn't exist yet, to avoid racing with
+    # another process between checking for it and writing it
+    try:
+      fd = os.open(project_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+      fd = None
       answer = None
-      while answer not in ('', 'y', 'n', 'yes', 'no'):
-        answer = raw_input("Project file %s already exists. Rewrite ([y]/n)?" % repr(project_file))
-      if answer == 'n':
+      while answer not in YES_NO_ANSWERS:
+        answer = input("Project file %s already exists. Rewrite ([y]/n)?" % repr(project_file)).strip().lower()
+      if answer.startswith('n'):
         return False
 
-    config = OrderedDict()
+    try:
+      config = self.build_project_config(path)
+    except:
+      # Don't leave behind an empty project file
+      if fd is not None:
+        os.close(fd)
+        os.remove(project_file)
+      raise
+
+    data = dump_project_config(config)
+    if fd is not None:
+      f = os.fdopen(fd, 'wb')
+    else:
+      f = open(project_file, 'wb')
+
+    with f:
+      f.write(data)
+
+    return True
+
+  def write_files_file(self, file_to_args):
+    """
+    Write the discovered source files and their arguments to a msgpack file,
+    which is faster to load than the JSON project file for big projects.
+
+    Returns the path of the file or None if msgpack isn't installed.
+    """
+    if not has_msgpack:
+      print("[!] msgpack isn't installed, keeping the files in the project file.")
+      return None
+
+    with open(MSGPACK_FILES_FILE, 'wb') as f:
+      msgpack.pack(file_to_args, f, use_bin_type=True)
+    return MSGPACK_FILES_FILE
+
+  def build_project_config(self, path):
+    config = {}
 
     # Add the CLang specific configuration section
+    includes = self.resolve_clang_includes()
     config['GENERAL'] = {
-      'clang-includes': self.resolve_clang_includes(),
+      'clang-includes': includes,
       'inlines': 0,
     }
-    config['GENERAL'] = OrderedDict(sorted(config['GENERAL'].items(), key=lambda x: x[0]))
+    if self.use_pch:
+      pch = self.create_prelude_pch(includes)
+      if pch is not None:
+        config['GENERAL']['pch'] = pch
 
     # Add the project specific configuration section
     base_path = os.path.basename(path)
@@ -107,7 +277,6 @@ class CSBDProject:
       "export-header": "{}-exported.h".format(os.path.join(PROJECT_PIGAIOS_DIR, base_path)),
       "export-indent": "clang-format -i",
     }
-    config['PROJECT'] = OrderedDict(sorted(config['PROJECT'].items(), key=lambda x: x[0]))
 
     # And now add all discovered source files
     if self.build_system == 'Makefile':
@@ -117,12 +286,14 @@ class CSBDProject:
       sag = SimpleArgsGenerator(path)
       file_to_args = sag.generate()
 
-    config['FILES'] = file_to_args
-
-    with open(project_file, 'w') as f:
-      json.dump(config, f, indent=4)
+    if self.use_msgpack:
+      files_file = self.write_files_file(file_to_args)
+      if files_file is not None:
+        config['GENERAL']['files-file'] = files_file
+        file_to_args = {}
 
-    return True
+    config['FILES'] = file_to_args
+    return config
 
 #-------------------------------------------------------------------------------
 class CSBDExporter:
@@ -152,17 +323,26 @@ class CSBDExporter:
 
 
 #-------------------------------------------------------------------------------
-def main():
+def _build_parser():
   parser = argparse.ArgumentParser(description=SBD_BANNER)
-  parser.add_argument('-create', help='Create a project in the current directory and discover source files.',
+  parser.add_argument('-create', '--create', help='Create a project in the current directory and discover source files.',
                       action='store_true')
   parser.add_argument('--build-system', help='Specify build system that is used for project. '
                                              'Available build systems: Makefile',
                       dest='build_system', default=None)
-  parser.add_argument('-export', help='Export the current project to one SQLite database.', action='store_true')
-  parser.add_argument('-project', help='Use <file> as the project filename.',
+  parser.add_argument('--pch', help='When creating a project, precompile the common C library headers and use them '
+                                    'for the C source files whose only arguments are include paths (they will see '
+                                    "these declarations even if they don't include the headers, and the structs, "
+                                    'unions, enums and typedefs of the headers will be exported).',
+                      action='store_true', dest='use_pch', default=False)
+  parser.add_argument('--msgpack-files', help='When creating a project, save the discovered source files to a '
+                                              'msgpack file instead of the project file (faster to load for big '
+                                              'projects, msgpack is required to export them).',
+                      action='store_true', dest='use_msgpack', default=False)
+  parser.add_argument('-export', '--export', help='Export the current project to one SQLite database.', action='store_true')
+  parser.add_argument('-project', '--project', help='Use <file> as the project filename.',
                       dest="project_file", default=DEFAULT_PROJECT_FILE)
-  parser.add_argument('-clang', help="Use the Clang Python bindings' to parse the source files (default)",
+  parser.add_argument('-clang', '--clang', help="Use the Clang Python bindings' to parse the source files (default)",
                       action='store_true', dest='use_clang', default=True)
   parser.add_argument('--no-parallel', help='Do not parallelize the compilation process (faster for small code bases).',
                       action='store_true', dest="parallel", default=False)
@@ -173,22 +353,44 @@ def main():
                       '*-exported.h file will be created. sqlite file will be created too, but without functions'
                       'data needed for IDA script matching',
                       action='store_true', dest='only_header_els', default=False)
-  parser.add_argument('-test', help='Test for the availability of exporters', action='store_true')
-  args = parser.parse_args()
+  parser.add_argument('-test', '--test', help='Test for the availability of exporters', action='store_true')
+  return parser
+
+_PARSER = _build_parser()
+
+#-------------------------------------------------------------------------------
+def main(argv=None):
+  args = _PARSER.parse_args(argv)
 
   if args.create:
-    sbd_project = CSBDProject(args.build_system)
+    sbd_project = CSBDProject(args.build_system, args.use_pch, args.use_msgpack)
     if sbd_project.create_project(os.getcwd(), args.project_file):
       print("Project file %s created." % repr(args.project_file))
   elif args.export:
     exporter = CSBDExporter(args.project_file, args.parallel)
     exporter.export(args.use_clang, args.only_header_els)
   elif args.profiling:
-    import cProfile
-    profiler = cProfile.Profile()
     exporter = CSBDExporter(args.project_file, args.parallel)
-    profiler.runcall(exporter.export, (args.use_clang, args.only_header_els,))
-    profiler.print_stats(sort="time")
+    try:
+      import yappi
+      has_yappi = True
+    except ImportError:
+      has_yappi = False
+
+    if has_yappi:
+      # Lower overhead than cProfile and it also sees the threads
+      yappi.set_clock_type("cpu")
+      yappi.start()
+      try:
+        exporter.export(args.use_clang, args.only_header_els)
+      finally:
+        yappi.stop()
+      yappi.get_func_stats().sort("ttot").print_all()
+    else:
+      import cProfile
+      profiler = cProfile.Profile()
+      profiler.runcall(exporter.export, args.use_clang, args.only_header_els)
+      profiler.print_stats(sort="time")
 
 
 if __name__ == "__main__":